@@ -0,0 +1,101 @@
+from datetime import datetime
+import threading
+import time
+
+'''
+Keeps the image cache populated from what Discord sends the bot anyway. Message content
+seen in interaction payloads is ingested into the cache, so the first edit of a canvas
+rarely has to fetch it. Reads follow stale-while-revalidate: an entry that has not been
+in sync with Discord for longer than the ttl is still returned immediately, and a refresh
+is fetched in the background.
+Content is only ingested if it is newer than the cached copy by its Discord timestamp.
+Entries holding local edits that Discord has not yet confirmed are never overwritten, so a
+late or stale response can not undo an edit, and are not refreshed. They are in sync again
+once the edit is confirmed, or are dropped and fetched again if the edit could not be sent.
+'''
+class CacheWarmer():
+
+    '''
+    cache - The ImgCache to populate
+    fetch - A function (channel id, message id) returning a Discord message object
+    pool - A thread pool to run refreshes on
+    parse - A function converting message content into the value to cache
+    ttl - Seconds an entry is served before it is refreshed
+    '''
+    def __init__(self, cache, fetch, pool, parse, ttl: int):
+        self.cache = cache
+        self.fetch = fetch
+        self.pool = pool
+        self.parse = parse
+        self.ttl = ttl
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    '''
+    Returns a tuple (value, version) for the key, or (None, 0) on a cache miss.
+    Schedules a refresh if the entry is stale and holds no unconfirmed edits.
+    '''
+    def get(self, key):
+        value, version, stamp, synced = self.cache.get_stamped(key)
+        if value is not None and stamp is not None and time.monotonic() - synced > self.ttl:
+            self.refresh(key)
+        return value, version
+
+    '''
+    Fetches the key in the background, unless a refresh of the key is already running.
+    '''
+    def refresh(self, key):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.pool.apply_async(self._refresh, args=[key])
+
+    def _refresh(self, key):
+        try:
+            self.ingest(key, self.fetch(*key))
+        except Exception:
+            pass #The stale entry is kept, a later read will try again
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    '''
+    Stores the content of a Discord message object if it is newer than the cached copy.
+    Returns True if the cache was updated.
+    '''
+    def ingest(self, key, message: dict):
+        stamp = CacheWarmer.stamp_of(message)
+        value, version, cached_stamp, synced = self.cache.get_stamped(key)
+        if value is not None:
+            if cached_stamp is None: #Holds local edits, which are newer than anything Discord has
+                return False
+            if CacheWarmer.parse_stamp(stamp) <= CacheWarmer.parse_stamp(cached_stamp):
+                if stamp == cached_stamp: #Unchanged, the entry is in sync again
+                    self.cache.stamp(key, version, stamp)
+                return False
+        return bool(self.cache.compare_and_swap(key, version, self.parse(message['content']), stamp))
+
+    '''
+    Records Discord's response to an edit of the cached version of a message.
+    '''
+    def confirm(self, key, version: int, message: dict):
+        self.cache.stamp(key, version, CacheWarmer.stamp_of(message))
+
+    '''
+    Records that an edit of the cached version of a message could not be sent. The entry holds
+    content Discord does not have, so it is dropped and Discord's copy is fetched in its place.
+    Does nothing if a newer version has been cached since, its edit is still to be sent.
+    '''
+    def failed(self, key, version: int):
+        if self.cache.discard(key, version):
+            self.refresh(key)
+
+    '''
+    Returns the timestamp of the last change to a Discord message object.
+    '''
+    def stamp_of(message: dict):
+        return message.get('edited_timestamp') or message['timestamp']
+
+    def parse_stamp(stamp: str):
+        return datetime.fromisoformat(stamp)
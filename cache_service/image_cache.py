@@ -1,26 +1,116 @@
+import itertools
+import threading
+import time
+
 '''
 The image cache is used to store copies of the image locally, so that we do not have
 to fetch the image every time we wish to edit it. The cache implements a LRU policy.
 Each entry is a key (channel id, message id).
+Every value written to the cache is stamped with a version number. Versions are drawn
+from a single process wide counter, so they only ever increase for a key and are never
+reused for different content, even after an entry is evicted and loaded again.
+Writers that must not overwrite a newer value use compare_and_swap with the version
+they read, and retry against the new value if it changed in between.
+Entries also record the Discord timestamp of the message content they hold, which is None
+while the entry holds local edits Discord has not confirmed, and the time they were last
+known to be in sync with Discord.
 '''
+_versions = itertools.count(1)
+
 class ImgCache():
     def __init__(self, size):
         self.size = size
         self.cache = {}
         self.lru = None
         self.mru = None
+        self.lock = threading.Lock()
 
     def get(self, key):
-        if key in self.cache:
-            cached = self.cache[key]
-            self.__update_lru(cached)
-            return cached.value
+        with self.lock:
+            if key in self.cache:
+                cached = self.cache[key]
+                self.__update_lru(cached)
+                return cached.value
+
+    '''
+    Returns a tuple (value, version) for the key, or (None, 0) on a cache miss.
+    '''
+    def get_versioned(self, key):
+        with self.lock:
+            if key in self.cache:
+                cached = self.cache[key]
+                self.__update_lru(cached)
+                return cached.value, cached.version
+            return None, 0
+
+    '''
+    Returns a tuple (value, version, stamp, synced) for the key, or (None, 0, None, 0) on a cache miss.
+    '''
+    def get_stamped(self, key):
+        with self.lock:
+            if key in self.cache:
+                cached = self.cache[key]
+                self.__update_lru(cached)
+                return cached.value, cached.version, cached.stamp, cached.synced
+            return None, 0, None, 0
 
-    def put(self, key, value):
+    '''
+    Stores the value and returns the version number it was given.
+    stamp (optional) - The Discord timestamp of the value, if it was read from Discord.
+    '''
+    def put(self, key, value, stamp=None):
+        with self.lock:
+            return self.__put(key, value, stamp)
+
+    '''
+    Records that the cached version of the key matches Discord's copy with the given timestamp.
+    Does nothing if the entry has been changed since version.
+    '''
+    def stamp(self, key, version, stamp):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and cached.version == version:
+                cached.stamp = stamp
+                cached.synced = time.monotonic()
+
+    '''
+    Removes the key from the cache if its cached version is still version.
+    Returns True if the entry was removed.
+    '''
+    def discard(self, key, version):
+        with self.lock:
+            cached = self.cache.get(key)
+            if not cached or cached.version != version:
+                return False
+            del self.cache[key]
+            if cached.prev:
+                cached.prev.next = cached.next
+            else:
+                self.lru = cached.next
+            if cached.next:
+                cached.next.prev = cached.prev
+            else:
+                self.mru = cached.prev
+            return True
+
+    '''
+    Stores the value only if the cached version of the key is still version, where a
+    version of 0 means the key must not be cached. Returns the new version, or 0 if the
+    entry was changed by another writer and the value was not stored.
+    '''
+    def compare_and_swap(self, key, version, value, stamp=None):
+        with self.lock:
+            cached = self.cache.get(key)
+            if (cached.version if cached else 0) != version:
+                return 0
+            return self.__put(key, value, stamp)
+
+    def __put(self, key, value, stamp):
         cached = None
         if key in self.cache:
             cached = self.cache[key]
             cached.value = value
+            cached.version = next(_versions)
         elif len(self.cache) < self.size:
             cached = ImageCacheEntry(key, value)
             self.cache[key] = cached
@@ -33,9 +123,17 @@ class ImgCache():
 
             cached = ImageCacheEntry(key, value)
             self.cache[key] = cached
+        cached.stamp = stamp
+        if stamp:
+            cached.synced = time.monotonic()
         self.__update_lru(cached)
+        return cached.version
 
     def __update_lru(self, cached):
+        #Entry is already mru, relinking it would point it at itself
+        if cached == self.mru:
+            return
+
         #Update entries old neighbors
         if cached.next:
             cached.next.prev = cached.prev
@@ -48,6 +146,7 @@ class ImgCache():
         if self.mru:
             self.mru.next = cached
         cached.prev = self.mru
+        cached.next = None
         self.mru = cached
         if not self.lru:
             self.lru = cached
@@ -56,5 +155,8 @@ class ImageCacheEntry():
     def __init__(self, key, value):
         self.key = key
         self.value = value
+        self.version = next(_versions)
+        self.stamp = None
+        self.synced = time.monotonic()
         self.prev = None
         self.next = None
\ No newline at end of file
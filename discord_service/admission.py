@@ -0,0 +1,97 @@
+from cache_service.image_cache import ImgCache
+import time
+
+'''
+A token bucket holding up to burst tokens, refilled at rate tokens per second.
+'''
+class TokenBucket():
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+'''
+A limit on how often a group of commands may run for each user, guild or canvas.
+'''
+class Limit():
+    def __init__(self, group: int, scope: str, rate: float, burst: int):
+        self.group = group
+        self.scope = scope
+        self.rate = rate
+        self.burst = burst
+
+'''
+Admission control for interactions. Each command can be limited per user, per guild and
+per canvas. Buckets are only created for ids that send interactions and are kept in an LRU
+cache, so ids that go quiet are forgotten once the cache is full.
+An interaction is admitted only if every bucket that applies to it has a token, in which
+case one token is taken from each.
+'''
+class Admission():
+
+    SCOPES = ('user', 'guild', 'canvas')
+
+    def __init__(self, size: int):
+        self.buckets = ImgCache(size)
+        self.limits = {}      #A map of command names to the list of limits that apply to them
+        self.groups = 0
+        self.canvas_key = lambda interaction: None #Returns the id of the canvas an interaction edits, if any
+
+    '''
+    Limits a group of commands for a scope. The commands share one bucket per user, guild or canvas.
+    commands - A list of command names
+    scope - One of SCOPES
+    rate - Tokens added per second
+    burst - The most tokens a bucket can hold
+    '''
+    def limit(self, commands: list, scope: str, rate: float, burst: int):
+        if scope not in Admission.SCOPES:
+            raise ValueError('Unknown scope: {}'.format(scope))
+        self.groups += 1
+        limit = Limit(self.groups, scope, rate, burst)
+        for command in commands:
+            self.limits.setdefault(command, []).append(limit)
+
+    '''
+    Takes tokens for an interaction. Returns None if it is admitted, otherwise the scope
+    of the limit that rejected it.
+    '''
+    def admit(self, command: str, interaction: dict):
+        limits = self.limits.get(command)
+        if not limits:
+            return None
+
+        now = time.monotonic()
+        buckets = []
+        for limit in limits:
+            id = self._scope_id(limit.scope, interaction)
+            if id is None:
+                continue
+            key = (limit.group, id)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(limit.rate, limit.burst, now)
+                self.buckets.put(key, bucket)
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                return limit.scope
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def _scope_id(self, scope: str, interaction: dict):
+        if scope == 'user':
+            user = interaction['member']['user'] if 'member' in interaction else interaction.get('user')
+            return user['id'] if user else None
+        elif scope == 'guild':
+            return interaction.get('guild_id')
+        return self.canvas_key(interaction)
@@ -0,0 +1,86 @@
+import threading
+import zlib
+import gzip
+import json
+import time
+import re
+
+'''
+Records the traffic of a bot to an append-only gzip file of json lines, for replay.py.
+Each line is one of
+    {"t": time, "in": gateway frame}
+    {"t": time, "out": {"m": method, "u": url, "b": body, "s": status, "r": response}}
+where the response is only kept for GET requests, the only responses the handlers read.
+Interaction tokens and session ids are replaced with REDACTED, in urls as well as payloads,
+and uploaded files are reduced to their name, size and crc32.
+'''
+class Capture():
+
+    REDACTED = 'REDACTED'
+    TOKEN_URL = re.compile(r'(/(?:interactions|webhooks)/\d+/)[^/]+')
+
+    def __init__(self, path: str):
+        self.file = gzip.open(path, 'ab')
+        self.lock = threading.Lock()
+
+    '''
+    Records a frame received from the gateway.
+    '''
+    def inbound(self, msg: str):
+        frame = json.loads(msg)
+        if isinstance(frame.get('d'), dict):
+            for field in ('token', 'session_id'):
+                if field in frame['d']:
+                    frame['d'][field] = Capture.REDACTED
+        self._write({'t': time.time(), 'in': frame})
+
+    '''
+    Records a request sent to Discord and the status of its response.
+    '''
+    def outbound(self, method: str, url: str, kwds: dict, res):
+        record = {
+            'm': method,
+            'u': Capture.redact_url(url),
+            'b': Capture.body(kwds),
+            's': res.status_code
+        }
+        if method == 'get':
+            try:
+                record['r'] = res.json()
+            except ValueError:
+                pass
+        self._write({'t': time.time(), 'out': record})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _write(self, record: dict):
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode() + b'\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush() #Keeps the file readable up to the last record if the bot is killed
+
+    def redact_url(url: str):
+        return Capture.TOKEN_URL.sub(r'\1' + Capture.REDACTED, url)
+
+    '''
+    Returns the json body of a request, with any uploaded files described instead of included.
+    '''
+    def body(kwds: dict):
+        if 'files' not in kwds:
+            return kwds.get('json')
+        body = json.loads(kwds['data']['payload_json'])
+        body['files'] = [[file[0], len(file[1]), zlib.crc32(file[1])] for file in kwds['files'].values()]
+        return body
+
+    '''
+    Yields the records of a capture file. A record cut off by the bot being killed ends the file.
+    '''
+    def read(path: str):
+        with gzip.open(path, 'rb') as f:
+            try:
+                for line in f:
+                    yield json.loads(line)
+            except (EOFError, ValueError):
+                return
@@ -1,3 +1,7 @@
+from discord_service.recent_ids import RecentIds
+from discord_service.admission import Admission
+from discord_service.transport import Transport
+from profiler import Profiler
 from stats import Stats
 from multiprocessing.dummy import Pool
 import websocket
@@ -5,7 +9,9 @@ import threading
 import requests
 import threading
 import signal
+import hashlib
 import json
+import os
 import time
 import sys
 
@@ -13,6 +19,8 @@ class Discbot:
 
     API_URL = 'https://discord.com/api'
 
+    WORKERS = 8 #Number of threads sending requests
+
     #Websocket Opcodes
     OP_DISPATCH = 0
     OP_HEARTBEAT = 1
@@ -24,11 +32,16 @@ class Discbot:
     OP_ACK = 11
 
     RESPOND_MSG = 4
+    RESPOND_DEFERED_MSG = 5
     RESPOND_DEFERED = 6
     RESPOND_EDIT = 7
 
+    #Interaction types
+    INTERACTION_COMPONENT = 3
+
     #Dispatch types
     TYPE_READY = 'READY'
+    TYPE_RESUMED = 'RESUMED'
     TYPE_INTERACTION = 'INTERACTION_CREATE'
 
     #Websocket close event codes in which a resume is not possible.
@@ -39,17 +52,25 @@ class Discbot:
     def __init__(self, app_id: str, token: str, shard_id: int, shard_total: int, log):
         self.app_id = app_id
         self.token = token
-        self.session = requests.Session()
-        self.session.stream = False
-        self.session.headers.update({'Authorization': 'Bot {}'.format(token)})
+        self.transport = Transport(token, Discbot.WORKERS)
         self.shard = [shard_id, shard_total] #The shard id is a single instance 0 to n-1, shard total is a number n of total instances running
         self.command_registry = {}   #A map of discord command names to there respective function callback
-        self.tpool = Pool(8)         #Thread pool for asynchorously running requests
+        self.commands = []           #Application commands to keep registered with Discord, see sync_commands
+        self.handled = RecentIds(4096) #Ids of recently handled interactions. Events replayed after a resume may repeat them.
+        self.admission = Admission(65536) #Rate limits applied to commands before their callback runs
+        self.tpool = Pool(Discbot.WORKERS) #Thread pool for asynchorously running requests
+        self.pending_edits = {}      #A map of (channel id, message id) to the newest (version, message) waiting or sent, message is None once sent
+        self.edit_lock = threading.Lock()
+        self.on_interaction = None   #Optional function called with every admitted interaction before its command callback
+        self.on_edited = None        #Optional function called with ((channel id, message id), version, message) after a versioned edit is sent
+        self.on_edit_failed = None   #Optional function called with ((channel id, message id), version) when a versioned edit could not be sent
+        self.capture = None          #Optional Capture recording gateway and REST traffic, see set_capture
 
         '''Data for websocket maintenence'''
         self.ws = None               #Websocket for which data is exchanged.
         self.ack = 1                 #Determines if an ack was recieved. If 0 when sending heartbeat, connection is bad. 
         self.sequence = 0            #The last sequence 's' sent by Discord.
+        self.sequence_lock = threading.Lock() #Guards sequence, which is read by the heartbeat thread.
         self.dispatch_sequence = 0   #The last sequence 's' sent by Discord with an opcode of DISPATCH. Used for resuming a connection.
         self.heartbeat_flag = 0      # 1: force heartbeat
         self.heartbeat_thread = None #Thread on which heartbeating runs.
@@ -59,10 +80,18 @@ class Discbot:
         self.resume_gateway_url = '' #Url used to resume a disconnected gateway.
         self.resume_session_id = ''  #Session id used to resume a disconnected gateway.
         self.resume_flag = 0         #Indicates wether a resume (1) or identify (0) should be sent on connection open.
+        self.resume_start = 0        #Time the resumable connection was lost, 0 if not resuming.
+        self.replaying = 0           #1 while Discord is replaying missed dispatches after a resume was sent.
+        self.replayed = 0            #Number of dispatches replayed during the current resume.
         
         '''General Setup'''
         self.log = log
+        self.profiler = Profiler(log, 'pixgs-s{}'.format(shard_id))
+        self.profile_command = '*'   #Command profiled on SIGUSR2, '*' for whichever command runs next
         signal.signal(signal.SIGINT, self.terminate)
+        #SIGUSR1 toggles the sampling profiler, SIGUSR2 profiles the next command callback
+        signal.signal(signal.SIGUSR1, lambda signal, frame: self.profiler.toggle())
+        signal.signal(signal.SIGUSR2, lambda signal, frame: self.profiler.arm(self.profile_command))
     
     '''
     Opens a websocket with the discord server so that the bot can begin exchanging data.
@@ -82,8 +111,9 @@ class Discbot:
         elif not resume and self.gateway_url:
             wss_url = self.gateway_url
         else:
-            res = self.session.get(
-                url=Discbot.API_URL + '/gateway/bot',
+            res = self.transport.request(
+                'get',
+                Discbot.API_URL + '/gateway/bot',
                 params = {'v': 10, 'encoding': 'json'}
             )
             if(Discbot.raise_for_status(res)):
@@ -106,18 +136,72 @@ class Discbot:
     '''
     Registers a Discord command. Used to callback to command functions when recieved by the websocket.
     @command - A dictionary that follows the Application Command Structure as specified by Discord docs
-    @callback - A pointer to the function to run when the command is run.
-    @post - Wether the command should be posted to Discord. This should be set to True to initialize the command
-              or each time you make an edit to the command paramater. Discord will store a copy once you
-              post it, therefore, it is not necesary to post more than once.
+    @callback - A pointer to the function to run when the command is run. Components are matched by the
+              part of their custom_id before the first ':', the rest is free for the component to carry data.
+    @post - Wether the command is an application command that should be registered with Discord.
+              Posted commands are sent to Discord by sync_commands, and only when they have changed.
     '''
     def register_command(self, command: dict, callback, post: bool):
         if post:
-            url = '{}/v10/applications/{}/commands'.format(Discbot.API_URL, self.app_id)
-            res = self.session.post(url, json=command)
-            Discbot.raise_for_status(res)
+            self.commands.append(command)
         self.command_registry[command['name']] = callback
 
+    '''
+    Makes the application commands registered with Discord match the posted commands.
+    The hash of the commands is compared with the one recorded in record_path by the last sync.
+    If it differs the registered commands are fetched with a single request, and only if
+    they differ all commands are replaced at once with Discord's bulk overwrite endpoint.
+    force - Skip the comparisons and always overwrite the commands.
+    '''
+    def sync_commands(self, record_path: str, force=False):
+        digest = hashlib.sha256(json.dumps(self.commands, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+        if not force and os.path.exists(record_path):
+            with open(record_path) as f:
+                if f.read().strip() == digest:
+                    self.log.info('Application commands are up to date.')
+                    return
+
+        url = '{}/v10/applications/{}/commands'.format(Discbot.API_URL, self.app_id)
+        if not force:
+            res = self.transport.request('get', url)
+            if not res.ok: #An error body says nothing about the commands, try again on the next start
+                self.log.error('Could not fetch application commands, skipping sync: {} {}'.format(res.status_code, res.text))
+                return
+            force = not Discbot._same_commands(self.commands, res.json())
+        if force:
+            self.log.info('Overwriting {} application commands.'.format(len(self.commands)))
+            res = self.transport.request('put', url, json=self.commands, timeout=10)
+            res.raise_for_status()
+        with open(record_path, 'w') as f:
+            f.write(digest)
+
+    '''
+    Compares local commands with the commands returned by Discord. Discord adds fields such as
+    ids and defaults to the commands it returns, so only the fields set locally are compared.
+    '''
+    def _same_commands(local, remote):
+        if isinstance(local, dict):
+            #Discord omits fields left at their default, such as 'required': False
+            return isinstance(remote, dict) and all(
+                Discbot._same_commands(v, remote[k]) if k in remote else not v for k, v in local.items()
+            )
+        if isinstance(local, list):
+            if not isinstance(remote, list) or len(local) != len(remote):
+                return False
+            if local and isinstance(local[0], dict) and 'name' in local[0]: #Commands and options are unordered, match them by name
+                remote = {r.get('name'): r for r in remote}
+                return all(Discbot._same_commands(l, remote.get(l['name'])) for l in local)
+            return all(Discbot._same_commands(l, r) for l, r in zip(local, remote))
+        return local == remote
+
+    '''
+    Starts recording the frames recieved from the gateway and the requests sent to Discord.
+    capture - A Capture, or None to stop recording
+    '''
+    def set_capture(self, capture):
+        self.capture = capture
+        self.transport.capture = capture
+
     '''
     Runs once after calling ws.run_forever(). Connection has been established
     and the bot must identify itself with Discord.
@@ -128,6 +212,8 @@ class Discbot:
 
         if self.resume_flag == 1:
             self.resume_flag = 0
+            self.replaying = 1
+            self.replayed = 0
             payload = {
                 'op': Discbot.OP_RESUME,
                 'd': {
@@ -167,24 +253,45 @@ class Discbot:
         self.log.error('The following error was encountered with the websocket: {}'.format(str(error)))
 
     def _on_msg(self, ws, msg):
+        if self.capture:
+            self.capture.inbound(msg)
         res = json.loads(msg)
-        self.sequence = res['s']
+        if res['s'] is not None:
+            with self.sequence_lock:
+                self.sequence = res['s']
         match res['op']:
             case Discbot.OP_DISPATCH:
                 self.dispatch_sequence = res['s']
+                if self.replaying and res['t'] != Discbot.TYPE_RESUMED:
+                    self.replayed += 1
                 if res['t'] == Discbot.TYPE_READY:
                     self.log.info('Handshake successful! Connection with Discord was established.')
                     self.resume_gateway_url = res['d']['resume_gateway_url']
                     self.resume_session_id = res['d']['session_id']
+                    self.transport.prewarm(force=True)
+                    self.replaying = 0
+                    self.resume_start = 0
+                elif res['t'] == Discbot.TYPE_RESUMED:
+                    self._on_resumed()
                 elif res['t'] == Discbot.TYPE_INTERACTION:
                     self.log.info('Got Interaction Command: {}'.format(res))
+                    if not self.handled.add(res['d']['id']):
+                        self.log.info('Dropped duplicate interaction {}'.format(res['d']['id']))
+                        Stats.duplicates += 1
+                        return
                     callback = None
                     if 'name' in res['d']['data']:
                         callback = res['d']['data']['name']
                     elif 'custom_id' in res['d']['data']:
-                        callback = res['d']['data']['custom_id']
+                        callback = res['d']['data']['custom_id'].partition(':')[0]
                     if callback in self.command_registry:
-                        self.command_registry[callback](res['d'])
+                        throttled = self.admission.admit(callback, res['d'])
+                        if throttled:
+                            self._throttle(res['d'], throttled)
+                        else:
+                            if self.on_interaction:
+                                self.on_interaction(res['d'])
+                            self.profiler.call(callback, self.command_registry[callback], res['d'])
             case Discbot.OP_HEARTBEAT:
                 self.log.info('Immediate heartbeat required')
                 self.heartbeat_flag = 1
@@ -204,6 +311,36 @@ class Discbot:
                 self.clean_up(restart=True, resumable=res['d'])
                 ws.close()
 
+    '''
+    Answers an interaction rejected by admission control as cheaply as possible.
+    Component interactions are acknowledged without changing the message, commands get a short hidden reply.
+    '''
+    def _throttle(self, interaction: dict, scope: str):
+        self.log.info('Throttled interaction {} by {} limit'.format(interaction['id'], scope))
+        Stats.throttled[scope] += 1
+        if interaction['type'] == Discbot.INTERACTION_COMPONENT:
+            url = '{}/v10/interactions/{}/{}/callback'.format(Discbot.API_URL, interaction['id'], interaction['token'])
+            self.tpool.apply_async(
+                self.transport.request,
+                args=['post', url],
+                kwds={'json': {'type': Discbot.RESPOND_DEFERED}, 'interaction_id': interaction['id']},
+                callback=Discbot.raise_for_status
+            )
+        else:
+            self.reply_interaction(interaction['id'], interaction['token'], 'Slow down! Try again in a few seconds.', hidden=True)
+
+    '''
+    Runs once Discord has finished replaying the dispatches missed while disconnected.
+    '''
+    def _on_resumed(self):
+        elapsed = (time.time() - self.resume_start) * 1000 if self.resume_start else 0
+        self.log.info('Resumed connection in {:.0f}ms, {} events replayed.'.format(elapsed, self.replayed))
+        Stats.resumes += 1
+        Stats.resume_ms += elapsed
+        Stats.replayed += self.replayed
+        self.replaying = 0
+        self.resume_start = 0
+
     '''
     Sends a periodic 'heartbeat' with the last recieved sequence number to keep the websocket alive.
     '''
@@ -220,11 +357,14 @@ class Discbot:
                     self.heartbeat_flag = 0
                     self.ack = 0
 
+                    with self.sequence_lock:
+                        sequence = self.sequence
                     ws.send(json.dumps({
                         'op': Discbot.OP_HEARTBEAT,
-                        'd': self.sequence
+                        'd': sequence
                     }))
                     Stats.out(self.log)
+                    self.transport.prewarm() #Reopens connections closed while idle
                 elif delta > interval: #Case if heartbeat should be sent but an ack was never gotten
                     self.clean_up(restart=True, resumable=False)
                     ws.close()
@@ -241,6 +381,8 @@ class Discbot:
             if resumable:
                 self.log.info('Websocket resume flag set.')
                 self.resume_flag = 1
+                if not self.resume_start:
+                    self.resume_start = time.time()
             else:
                 self.log.info('Websocket restart flag set.')
         else:
@@ -257,8 +399,9 @@ class Discbot:
     components (optional) - An array of Discord component objects.
     edit - If true a message is edited instead of creating a new one. Default: False.
     hidden - If true a message is only visible to the user who started the interaction. Default: False.
+    files (optional) - An array of (filename, bytes, content type) tuples to upload as attachments.
     '''
-    def reply_interaction(self, interaction_id: str, interaction_token: str, msg: str, components=None, edit=False, hidden=False):
+    def reply_interaction(self, interaction_id: str, interaction_token: str, msg: str, components=None, edit=False, hidden=False, files=None):
         url = '{}/v10/interactions/{}/{}/callback'.format(Discbot.API_URL, interaction_id, interaction_token)
         data = {
             'type': Discbot.RESPOND_EDIT if edit else Discbot.RESPOND_MSG,
@@ -268,25 +411,111 @@ class Discbot:
                 'flags': 1 << 6 if hidden else 0
             }
         }
-        self.tpool.apply_async(self.session.post, args=[url], kwds={'json': data, 'timeout': 2}, callback=Discbot.raise_for_status)
+        kwds = Discbot._multipart(data, data['data'], files) if files else {'json': data}
+        kwds['interaction_id'] = interaction_id
+        self.tpool.apply_async(self.transport.request, args=['post', url], kwds=kwds, callback=Discbot.raise_for_status)
+
+    '''
+    Acknowledges a TYPE_INTERACT event whose reply will take longer than Discord allows.
+    The user sees a loading state until edit_interaction_reply is called with the result.
+    hidden - If true the eventual reply is only visible to the user who started the interaction. Default: False.
+    then (optional) - A function run on the same thread once Discord has accepted the deferral.
+        Work that ends in edit_interaction_reply must be started here, since an edit that reaches
+        Discord before the deferral fails.
+    '''
+    def defer_interaction(self, interaction_id: str, interaction_token: str, hidden=False, then=None):
+        url = '{}/v10/interactions/{}/{}/callback'.format(Discbot.API_URL, interaction_id, interaction_token)
+        data = {
+            'type': Discbot.RESPOND_DEFERED_MSG,
+            'data': {
+                'flags': 1 << 6 if hidden else 0
+            }
+        }
+        def send():
+            res = self.transport.request('post', url, json=data, interaction_id=interaction_id)
+            Discbot.raise_for_status(res)
+            if then:
+                then()
+        self.tpool.apply_async(send)
+
+    '''
+    Edits the reply to an interaction, such as one previously acknowledged with defer_interaction.
+    Interaction tokens remain valid for 15 minutes.
+    files (optional) - An array of (filename, bytes, content type) tuples to upload as attachments.
+    '''
+    def edit_interaction_reply(self, interaction_token: str, msg: str, components=None, files=None):
+        uri = '{}/v10/webhooks/{}/{}/messages/@original'.format(Discbot.API_URL, self.app_id, interaction_token)
+        reply = {
+            'content': msg,
+            'components': components
+        }
+        kwds = Discbot._multipart(reply, reply, files) if files else {'json': reply}
+        self.tpool.apply_async(self.transport.request, args=['patch', uri], kwds=kwds, callback=Discbot.raise_for_status)
+
+    '''
+    Returns the request arguments sending a json payload with files as multipart form data.
+    Discord reads the json from the 'payload_json' field, where message lists the attachments.
+    '''
+    def _multipart(payload: dict, message: dict, files: list):
+        message['attachments'] = [{'id': i, 'filename': file[0]} for i, file in enumerate(files)]
+        return {
+            'data': {'payload_json': json.dumps(payload)},
+            'files': {'files[{}]'.format(i): file for i, file in enumerate(files)}
+        }
 
     '''
     Edits a previously sent message. If editing when responding to a TYPE_INTERACTION
     event, reply_interaction should be used instead.
+    version (optional) - The version of the message content. Edits to the same message are
+        sent one at a time in version order. An edit that is superseded by a newer version
+        before it is sent is dropped, since the newer content already includes it.
     '''
-    def edit_message(self, channel_id: str, message_id: str, msg: str, components=None):
+    def edit_message(self, channel_id: str, message_id: str, msg: str, components=None, version=None):
         uri = '{}/channels/{}/messages/{}'.format(Discbot.API_URL, channel_id, message_id)
         reply = {
             'content': msg
         }
-        self.tpool.apply_async(self.session.patch, args=[uri], kwds={'json': reply, 'timeout': 2}, callback=Discbot.raise_for_status)
+        if version is None:
+            self.tpool.apply_async(self.transport.request, args=['patch', uri], kwds={'json': reply}, callback=Discbot.raise_for_status)
+            return
+
+        key = (channel_id, message_id)
+        with self.edit_lock:
+            if key in self.pending_edits: #An edit is in flight, the sender will pick this one up when it completes
+                #Edits older than the one waiting or in flight are already included in it
+                if self.pending_edits[key][0] < version:
+                    self.pending_edits[key] = (version, reply)
+                return
+            self.pending_edits[key] = (version, reply)
+        self.tpool.apply_async(self._send_edits, args=[key, uri])
+
+    '''
+    Sends the pending edits of a message until none remain. Only one sender runs per message.
+    '''
+    def _send_edits(self, key: tuple, uri: str):
+        while 1:
+            with self.edit_lock:
+                pending = self.pending_edits[key]
+                if not pending[1]:
+                    del self.pending_edits[key]
+                    return
+                self.pending_edits[key] = (pending[0], None) #Marks the version as in flight
+            try:
+                res = self.transport.request('patch', uri, json=pending[1])
+                res.raise_for_status()
+                if self.on_edited:
+                    self.on_edited(key, pending[0], res.json())
+            except Exception as e:
+                self.log.error('Edit of message {} version {} failed: {}'.format(key, pending[0], e))
+                if self.on_edit_failed:
+                    self.on_edit_failed(key, pending[0])
 
     '''
     Returns a message's content given the channel id and message id
     '''
     def get_message(self, channel_id: str, message_id: str):
         uri = '{}/channels/{}/messages/{}'.format(Discbot.API_URL, channel_id, message_id)
-        res = self.session.get(uri)
+        res = self.transport.request('get', uri)
         Discbot.raise_for_status(res)
         return res.json()
 
@@ -0,0 +1,27 @@
+'''
+A bounded record of the most recently seen ids. Ids are kept in a fixed size ring so
+the oldest id is forgotten once the ring is full, and mirrored in a set for O(1) lookups.
+'''
+class RecentIds():
+    def __init__(self, size):
+        self.size = size
+        self.ring = [None] * size
+        self.ids = set()
+        self.head = 0
+
+    '''
+    Records an id. Returns True if the id is new, False if it was already recorded.
+    '''
+    def add(self, id):
+        if id in self.ids:
+            return False
+        oldest = self.ring[self.head]
+        if oldest is not None:
+            self.ids.discard(oldest)
+        self.ring[self.head] = id
+        self.ids.add(id)
+        self.head = (self.head + 1) % self.size
+        return True
+
+    def __contains__(self, id):
+        return id in self.ids
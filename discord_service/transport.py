@@ -0,0 +1,95 @@
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import time
+
+'''
+Sends the bot's http requests to Discord. Interaction callbacks and webhooks use a separate
+connection pool from channel routes, so a burst of message edits can never hold every
+connection while an interaction is waiting to be answered. Both pools are sized to the
+number of threads sending requests, and can be warmed up ahead of time so the first
+interactions after connecting or idling do not pay for a new TLS handshake.
+'''
+class Transport():
+
+    WARM_URL = 'https://discord.com/api/v10/gateway'
+
+    DISCORD_EPOCH = 1420070400000
+
+    '''Seconds Discord allows for the initial response to an interaction'''
+    INTERACTION_DEADLINE = 3
+
+    CONNECT_TIMEOUT = 1
+    READ_TIMEOUT = 3
+    '''The least time given to an interaction callback, even if its deadline has passed'''
+    MIN_TIMEOUT = .5
+
+    '''Seconds a pool can go unused before its connections are assumed closed by the server'''
+    IDLE_REWARM = 30
+
+    '''
+    token - The bot token used to authorize requests
+    workers - The number of threads sending requests
+    '''
+    def __init__(self, token: str, workers: int):
+        self.workers = workers
+        #One extra connection for requests made synchronously outside the worker threads
+        self.interactions = Transport._session(token, workers)
+        self.channels = Transport._session(token, workers + 1)
+        self.last_used = {id(self.interactions): 0, id(self.channels): 0}
+        self.capture = None #Optional Capture recording every request
+
+    def _session(token: str, pool_size: int):
+        session = requests.Session()
+        session.stream = False
+        session.headers.update({'Authorization': 'Bot {}'.format(token)})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        return session
+
+    '''
+    Sends a request on the pool for its route and returns the response.
+    interaction_id (optional) - For an interaction callback, the timeout is limited to the
+        time left before Discord stops accepting a response to the interaction.
+    '''
+    def request(self, method: str, url: str, interaction_id=None, **kwds):
+        session = self.interactions if '/interactions/' in url or '/webhooks/' in url else self.channels
+        if interaction_id:
+            kwds['timeout'] = self.budget(interaction_id)
+        elif 'timeout' not in kwds:
+            kwds['timeout'] = (Transport.CONNECT_TIMEOUT, Transport.READ_TIMEOUT)
+        self.last_used[id(session)] = time.time()
+        res = session.request(method, url, **kwds)
+        if self.capture:
+            self.capture.outbound(method, url, kwds, res)
+        return res
+
+    '''
+    Returns a (connect, read) timeout that ends when the response to an interaction is due.
+    The creation time of an interaction is encoded in its snowflake id.
+    '''
+    def budget(self, interaction_id: str):
+        created = ((int(interaction_id) >> 22) + Transport.DISCORD_EPOCH) / 1000
+        remaining = max(Transport.INTERACTION_DEADLINE - (time.time() - created), Transport.MIN_TIMEOUT)
+        return (min(Transport.CONNECT_TIMEOUT, remaining), remaining)
+
+    '''
+    Opens connections to Discord on both pools, one request per connection the worker threads
+    can use. Requests are sent from short lived threads of their own, so warming never queues
+    ahead of the replies waiting on the worker threads.
+    Only pools unused for IDLE_REWARM seconds are warmed unless force is set.
+    '''
+    def prewarm(self, force=False):
+        now = time.time()
+        for session in [self.interactions, self.channels]:
+            if force or now - self.last_used[id(session)] > Transport.IDLE_REWARM:
+                self.last_used[id(session)] = now
+                #Concurrent requests each check out their own connection
+                for i in range(self.workers):
+                    threading.Thread(target=Transport._warm, args=[session], daemon=True).start()
+
+    def _warm(session):
+        try:
+            session.head(Transport.WARM_URL, timeout=(Transport.CONNECT_TIMEOUT, Transport.READ_TIMEOUT))
+        except requests.RequestException:
+            pass
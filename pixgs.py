@@ -1,36 +1,43 @@
 from discord_service.discbot import Discbot
 from cache_service.image_cache import ImgCache
+from cache_service.cache_warmer import CacheWarmer
+from render_service.attachments import HttpAttachmentFetcher
+from render_service.rows import RowCanvas
 from stats import Stats
+import multiprocessing
 import logging
-from logging.handlers import RotatingFileHandler
-from dotenv import load_dotenv
+import base64
+import struct
+import threading
+import signal
 import copy
 import time
+import re
 import sys
 import os
 
-load_dotenv()
-
-CLIENT_ID = os.getenv("CLIENT_ID")
-TOKEN = os.getenv("TOKEN")
-SHARD_ID = os.getenv("SHARD_ID")
-SHARD_TOTAL = os.getenv("SHARD_TOTAL")
-
-handle = RotatingFileHandler('pixgs-s%s.log' % SHARD_ID, mode='a', maxBytes=1024*1024*1024, encoding='utf-8')
-handle.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(lineno)d %(message)s'))
-handle.setLevel(logging.INFO)
-
+'''
+Everything below is created by main(). Work that is only needed by some commands, such as
+importing numpy or starting the converter processes, is deferred until first use so that
+a shard can identify itself with Discord as soon as possible after starting.
+'''
 log = logging.getLogger('logger')
-log.setLevel(logging.INFO)
-log.addHandler(handle)
+bot = None
+imgcache = None
+warmer = None
+attachments = None
+renderer = None  #Renders canvases as png images, see get_renderer()
+converter = None #Process pool converting uploaded images, see get_converter()
+lazy_lock = threading.Lock() #Guards creating renderer and converter, which happens on worker threads
 
-bot = Discbot(CLIENT_ID, TOKEN, int(SHARD_ID), int(SHARD_TOTAL), log)
-imgcache = ImgCache(65536)
+'''File recording the hash of the application commands last registered with Discord'''
+COMMAND_RECORD = 'pixgs-commands.sha256'
 
 MESSAGE_COMMAND = 1
 OP_STRING = 3
 OP_INTEGER = 4
 OP_BOOL = 5
+OP_ATTACHMENT = 11
 
 CONTAINER = 1
 BUTTON = 2
@@ -67,6 +74,22 @@ class Canvas:
         'BROWN': '🤎'
     }
 
+    '''The rgb value each color is rendered with when exporting an image'''
+    ENUM_RGB = {
+        'WHITE': (0xE6, 0xE7, 0xE8),
+        'BLACK': (0x31, 0x37, 0x3D),
+        'BLUE': (0x55, 0xAC, 0xEE),
+        'ORANGE': (0xF4, 0x90, 0x0C),
+        'PURPLE': (0xAA, 0x8E, 0xD6),
+        'GREEN': (0x78, 0xB1, 0x59),
+        'YELLOW': (0xFD, 0xCB, 0x58),
+        'RED': (0xDD, 0x2E, 0x44),
+        'BROWN': (0xC1, 0x69, 0x4F)
+    }
+
+    '''Matches a Discord message link, capturing the guild id, channel id and message id, or a plain message id'''
+    MESSAGE_LINK = re.compile(r'^(?:https?://(?:\w+\.)?discord(?:app)?\.com/channels/(\d+|@me)/(\d+)/)?(\d+)/?$')
+
     '''
     A Discord component object used to initiate editing of a canvas
     '''
@@ -89,7 +112,9 @@ class Canvas:
     ]
 
     '''
-    A Discord component object used to describe the drawing controls
+    A Discord component object used to describe the drawing controls.
+    Each custom_id is suffixed with ':' and a CanvasState token when the controller is sent,
+    so the state of the editor is returned with every interaction without storing it locally.
     '''
     CONTROLLER_COMPONENT = [
         {
@@ -165,25 +190,6 @@ class Canvas:
                         'name': '❤'
                     },
                     'label': 'Toggle Cursor'
-                },
-                #The following components are disabled buttons.
-                #Instead of a real id, button 0 stores a channel id for the original canvas
-                #Instead of a real id, button 1 stores a message id for the original canvas 
-                #This is useful for calling back to edit the original canvas without having to locally store any data
-                #These components will be returned with each edit, and while hacky appears to work
-                {
-                    'type': BUTTON,
-                    'style': STYLE_PRIMARY,
-                    'custom_id': '',
-                    'label': ' ',
-                    'disabled': True
-                },
-                {
-                    'type': BUTTON,
-                    'style': STYLE_PRIMARY,
-                    'custom_id': '',
-                    'label': ' ',
-                    'disabled': True
                 }
             ]
         }
@@ -194,48 +200,109 @@ class Canvas:
     '''
     def canvas(w: int, h: int, fill=None):
         fill_color = Canvas.ENUM_COLORS[fill if fill else 'WHITE']
-        return (fill_color * w + '\n') * h
-
-    '''
-    Parses a canvas to determine the cursor position, width, and height
-    '''
-    def load_canvas(content):
-        w = 0
-        h = 1
-        cur = -1
-        lock = -1
-        linebreak = None
-        for i in range(len(content)):
-            if content[i] == '\0':
-                break
-            if content[i] == '\n':
-                h += 1
-                linebreak = True
-            elif not linebreak:
-                w+=1
-            for color in Canvas.ENUM_CURSOR:
-                if content[i] == Canvas.ENUM_CURSOR[color]:
-                    cur = i
-        return cur, w, h
+        return RowCanvas.blank(w, h, fill_color).content
 
     '''
     Attempts to gets an image from the cache with the id (guild_id, message_id).
     If the image is not cached a request is made to discord for the image,
-    and then the image is stored in cache. 
+    and then the image is stored in cache. Images are cached as a RowCanvas.
     Optional paramater no_cache:
         if True, returns 0 on a cache miss
         if False, the standard behavior as described above occurs 
     '''
     def get_image(guild_id, message_id, no_cache=False):
-        image = imgcache.get((guild_id, message_id))
+        image, version = Canvas.get_versioned_image(guild_id, message_id, no_cache)
+        return image
+
+    '''
+    Same as get_image, but returns a tuple (image, version) where version is the
+    version number of the image in the cache. On a miss with no_cache (0, 0) is returned.
+    '''
+    def get_versioned_image(guild_id, message_id, no_cache=False):
+        image, version = warmer.get((guild_id, message_id))
         if image:
-            return image
+            return image, version
         elif no_cache:
-            return 0
+            return 0, 0
         else:
-            image = bot.get_message(guild_id, message_id)['content']
-            imgcache.put((guild_id, message_id), image)
-            return image
+            return Canvas.fetch_image(guild_id, message_id)
+
+    '''
+    Fetches a public canvas from Discord and stores it in the image cache.
+    Returns a tuple (image, version), where version is 0 if the image could not be cached.
+    Raises ValueError if the message is not a canvas.
+    '''
+    def fetch_image(channel_id, message_id):
+        message = bot.get_message(channel_id, message_id)
+        if not Canvas.is_canvas(message):
+            raise ValueError('Message {} is not a canvas'.format(message_id))
+        #Not stored if another writer cached the image while it was fetched, their copy is newer
+        warmer.ingest((channel_id, message_id), message)
+        image, version = warmer.get((channel_id, message_id))
+        return image or RowCanvas.parse(message['content']), version
+
+    '''
+    Stores the content of a public canvas in the image cache if an interaction carries it.
+    Called for every interaction, so canvases are usually cached before their first edit.
+    '''
+    def ingest(command_response: dict):
+        message = command_response.get('message')
+        if not message or message.get('flags', 0) & 1 << 6: #Ephemeral messages are edit copies
+            return
+        if Canvas.is_canvas(message):
+            warmer.ingest((message['channel_id'], message['id']), message)
+
+    '''
+    Returns True if a Discord message object is a public canvas, which carries the edit button.
+    '''
+    def is_canvas(message: dict):
+        components = message.get('components')
+        return bool(components) and components[0]['components'][0].get('custom_id') == 'edit'
+
+    '''
+    Applies a delta, a list of per pixel changes (index, character), to the cached copy of a
+    public image. The delta is applied to whichever
+    version of the image is current, so edits made concurrently by other users are kept.
+    Returns a tuple (image, version) of the updated image.
+    '''
+    def edit_image(channel_id, message_id, delta: list):
+        while 1:
+            image, version = Canvas.get_versioned_image(channel_id, message_id)
+            image = image.edit(delta)
+            version = imgcache.compare_and_swap((channel_id, message_id), version, image)
+            if version:
+                return image, version
+
+    '''
+    Returns the (channel_id, message_id) referenced by a message link. A plain message id
+    is also accepted, in which case the message is looked up in channel_id.
+    Returns None if the link is not recognized or points outside channel_id in guild_id, the
+    channel and guild the command was used in (guild_id is None in direct messages). The bot
+    reads messages with its own permissions, so only the channel the user is in is allowed.
+    '''
+    def parse_message_link(link: str, channel_id: str, guild_id):
+        match = Canvas.MESSAGE_LINK.match(link.strip())
+        if not match:
+            return None
+        guild, channel, message = match.groups()
+        if channel and (guild != (guild_id or '@me') or channel != channel_id):
+            return None
+        return channel_id, message
+
+    '''
+    Returns the canvas width and height limits enforced by the '/canvas' command.
+    '''
+    def max_size():
+        return canvas_command['options'][0]['max_value'], canvas_command['options'][1]['max_value']
+
+    '''
+    Returns the palette used to render exported images, in the order of ENUM_COLORS.
+    '''
+    def palette():
+        return [
+            ((Canvas.ENUM_COLORS[color], Canvas.ENUM_CURSOR[color]), Canvas.ENUM_RGB[color])
+            for color in Canvas.ENUM_COLORS
+        ]
 
     '''
     Returns the key 'Color' of the cursor or pixel object for use with ENUM_COLORS/ENUM_CURSOR
@@ -271,8 +338,7 @@ class Canvas:
         return color_list
 
     '''
-    Returns a deep copy of the controller component where the dropdown has the
-    select menu set to the desired color.
+    Sets the select menu of the controllers dropdown to the desired color.
     color - A key from ENUM_COLORS
     '''
     def set_controller_color(controller: dict, color: str):
@@ -284,31 +350,152 @@ class Canvas:
         return controller
 
     '''
-    Returns a deep copy of the controller component where the dropdown is copied
-    from the current command response.
-    command_response - The interaction object taken as a paramater to a webhook callback
+    Returns a deep copy of the controller component carrying the editor state.
+    state - A CanvasState
     '''
-    def copy_controller(command_response: dict):
+    def controller(state):
+        token = ':' + state.pack()
         controller = copy.deepcopy(Canvas.CONTROLLER_COMPONENT)
-        dropdown = command_response['message']['components'][1]
-        data = command_response['message']['components'][2]
-        controller[1] = dropdown
-        controller[2] = data
-        return controller
+        for row in controller:
+            for component in row['components']:
+                component['custom_id'] += token
+        return Canvas.set_controller_color(controller, state.color)
+
+    '''
+    Returns the canvas shown by an editor. For a public canvas whose cached version differs
+    from the version the editor last showed, the editor is behind other users' edits, so the
+    cached copy is returned instead, with the cursor drawn if shown, and state.version is updated.
+    '''
+    def editor_image(command_response: dict, state):
+        if not state.private:
+            image, version = Canvas.get_versioned_image(state.channel_id, state.message_id, no_cache=True)
+            if image and version != state.version:
+                state.version = version
+                if state.shown:
+                    image = image.edit([(state.cursor, Canvas.ENUM_CURSOR[Canvas.color_from_char(image.cell(state.cursor))])])
+                return image
+        return RowCanvas.parse(command_response['message']['content'])
+
+    '''
+    Returns the message id of the public canvas an interaction edits, or None for
+    private canvases and commands that do not act on a canvas.
+    '''
+    def canvas_ref(command_response: dict):
+        if 'message' not in command_response:
+            return None
+        if command_response['data'].get('custom_id') == 'edit':
+            return command_response['message']['id']
+        state = CanvasState.from_interaction(command_response)
+        return state.message_id if state else None
+
+    '''
+    Replies to an interaction from a controller that carries no state, such as one
+    sent before the state was stored in custom ids.
+    '''
+    def expired(command_response: dict):
+        bot.reply_interaction(
+            command_response['id'],
+            command_response['token'],
+            'This editor has expired. Press Edit Canvas on the canvas to open a new one.',
+            hidden=True
+        )
+
+'''
+The state of a canvas editor, packed into a token carried in the custom ids of its controller.
+channel_id, message_id - The public canvas being edited, None for a private canvas
+cursor - The index of the cursor in the canvas content
+color - The selected color, a key from ENUM_COLORS
+shown - Wether the cursor is drawn
+version - The version of the public canvas the editor last showed, the editor is refreshed
+          from the image cache when it differs
+'''
+class CanvasState():
+    __slots__ = ('channel_id', 'message_id', 'cursor', 'color', 'shown', 'version')
+
+    #Token layout: format, channel id, message id, cursor, color, flags, version
+    FORMAT = 2
+    LAYOUT = struct.Struct('<BQQHBBQ')
+
+    def __init__(self, channel_id=None, message_id=None, cursor=0, color='BLACK', shown=False, version=0):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.cursor = cursor
+        self.color = color
+        self.shown = shown
+        self.version = version
+
+    @property
+    def private(self):
+        return self.channel_id is None
+
+    def pack(self):
+        data = CanvasState.LAYOUT.pack(
+            CanvasState.FORMAT,
+            int(self.channel_id or 0),
+            int(self.message_id or 0),
+            self.cursor,
+            COLORS.index(self.color),
+            1 if self.shown else 0,
+            self.version
+        )
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    '''
+    Decodes a token created by pack. Returns None if the token is not valid.
+    '''
+    def unpack(token: str):
+        try:
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            fmt, channel_id, message_id, cursor, color, flags, version = CanvasState.LAYOUT.unpack(data)
+        except (ValueError, struct.error):
+            return None
+        if fmt != CanvasState.FORMAT or color >= len(COLORS):
+            return None
+        return CanvasState(
+            str(channel_id) if channel_id else None,
+            str(message_id) if message_id else None,
+            cursor,
+            COLORS[color],
+            bool(flags & 1),
+            version
+        )
 
     '''
-    Extracts data stored in discord components.
-    Returns channel_id, message_id
+    Returns the state carried in the custom id of the component that sent an interaction, or None.
     '''
-    def unpack_data(command_response: dict):
-        tk_args = command_response['message']['components'][2]['components']
-        channel_id = tk_args[1]['custom_id']
-        message_id = tk_args[2]['custom_id']
-        return channel_id, message_id
+    def from_interaction(command_response: dict):
+        return CanvasState.unpack(command_response['data'].get('custom_id', '').partition(':')[2])
+
+#Color names in token order
+COLORS = list(Canvas.ENUM_COLORS)
 
 #Set color select dropdown options
 Canvas.CONTROLLER_COMPONENT[1]['components'][0]['options'] = Canvas.colors_to_list(1)
 
+'''
+Returns the png renderer, importing numpy and creating it on first use.
+'''
+def get_renderer():
+    global renderer
+    with lazy_lock:
+        if not renderer:
+            from render_service.png_export import PngRenderer
+            renderer = PngRenderer(Canvas.palette(), 4096)
+        return renderer
+
+'''
+Returns the process pool used to convert images, starting it on first use.
+Workers are started from a fork server since the bot process is running threads by then.
+Workers ignore SIGINT, shutdown is handled by the parent process.
+'''
+def get_converter():
+    global converter
+    with lazy_lock:
+        if not converter:
+            context = multiprocessing.get_context('forkserver')
+            converter = context.Pool(2, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        return converter
+
 #Discord application command structure for command '/canvas'
 canvas_command = {
     'name': 'canvas',
@@ -347,6 +534,56 @@ canvas_command = {
     ]
 }
 
+#Discord application command structure for command '/export'
+export_command = {
+    'name': 'export',
+    'type': MESSAGE_COMMAND,
+    'description': 'Export a canvas as a png image',
+    'options': [
+        {
+            'type': OP_STRING,
+            'name': 'message',
+            'description': 'A link to a canvas in this channel',
+            'required': True
+        },
+        {
+            'type': OP_INTEGER,
+            'name': 'scale',
+            'description': 'The size in pixels of each canvas pixel (default: 16)',
+            'required': False,
+            'min_value': 1,
+            'max_value': 64
+        }
+    ]
+}
+
+#Discord application command structure for command '/import'
+import_command = {
+    'name': 'import',
+    'type': MESSAGE_COMMAND,
+    'description': 'Create a canvas from an image',
+    'options': [
+        {
+            'type': OP_ATTACHMENT,
+            'name': 'image',
+            'description': 'The image to convert',
+            'required': True
+        },
+        {
+            'type': OP_BOOL,
+            'name': 'dither',
+            'description': 'Blend colors with a dither pattern (default: false)',
+            'required': False
+        },
+        {
+            'type': OP_BOOL,
+            'name': 'private',
+            'description': 'Only you can see and edit the image (default: false)',
+            'required': False
+        }
+    ]
+}
+
 #Discord application command structure for command '/help'
 help_command = {
     'name': 'help',
@@ -368,14 +605,11 @@ def canvas(command_response):
         optional_args[command_response['data']['options'][3]['name']] = command_response['data']['options'][3]['value']
 
     image = Canvas.canvas(w, h, optional_args['fill'])
-    controller = copy.deepcopy(Canvas.CONTROLLER_COMPONENT)
-    controller[2]['components'][1]['custom_id'] = 'none'
-    controller[2]['components'][2]['custom_id'] = 'none-1'
     bot.reply_interaction(
         command_response['id'],
         command_response['token'],
         image,
-        components=controller if optional_args['private'] else Canvas.EDIT_COMPONENT,
+        components=Canvas.controller(CanvasState()) if optional_args['private'] else Canvas.EDIT_COMPONENT,
         hidden=optional_args['private']
     )
     Stats.canvases += 1
@@ -384,17 +618,18 @@ def canvas(command_response):
 Callback function to enter 'edit mode', where a user can begin editing a canvas
 '''
 def edit_mode(command_response):
-    image = command_response['message']['content']
-    controller = copy.deepcopy(Canvas.CONTROLLER_COMPONENT)
-    #Split the token into chunks and store it into disabled button
-    controller[2]['components'][1]['custom_id'] = command_response['message']['channel_id']
-    controller[2]['components'][2]['custom_id'] = command_response['message']['id']
+    channel_id = command_response['message']['channel_id']
+    message_id = command_response['message']['id']
+    #The cached copy can hold edits the interaction's copy of the message does not show yet
+    image_public, version = Canvas.get_versioned_image(channel_id, message_id, no_cache=True)
+    image = image_public.content if image_public else command_response['message']['content']
+    state = CanvasState(channel_id, message_id, version=version)
 
     bot.reply_interaction(
       command_response['id'],
       command_response['token'],
       image,
-      components=controller,
+      components=Canvas.controller(state),
       hidden=True
     )
     Stats.edit += 1
@@ -403,108 +638,164 @@ def edit_mode(command_response):
 Callback function for moving the drawing cursor
 '''
 def move(command_response):
-    direction = command_response['data']['custom_id']
-    channel_id, message_id = Canvas.unpack_data(command_response)
-    private = channel_id == None
-    image = command_response['message']['content']
-    #Attempt to load updated copy of public image if it exists in cache, otherwise we just use our edit copy
-    image_public = None
-    if not private:
-        image_public = Canvas.get_image(channel_id, message_id, no_cache=True)
-
-    cur, w, h = Canvas.load_canvas(image)
-    new_cur = 0
-    
-    if cur == -1:
-        cur = 0
-    if image_public: #Refresh edit copy of image in case of cache hit
-        image = image_public[:cur] + Canvas.ENUM_CURSOR[Canvas.color_from_char(image_public[cur])] + image_public[cur+1:]
-
-    row = int(cur / (w+1))
-
-    if direction == 'left' and cur > 0 and image[cur - 1] != '\n':
-        new_cur = cur - 1
-    elif direction == 'left':
-        new_cur = cur + w-1
-    elif direction == 'right' and cur < len(image) - 1 and image[cur + 1] != '\n':
-        new_cur = cur + 1
+    state = CanvasState.from_interaction(command_response)
+    if not state:
+        return Canvas.expired(command_response)
+    direction = command_response['data']['custom_id'].partition(':')[0]
+    image = Canvas.editor_image(command_response, state)
+
+    #The cursor wraps around to the opposite edge of the canvas
+    cur = state.cursor
+    row, col = divmod(cur, image.w+1)
+    if direction == 'left':
+        col = (col - 1) % image.w
     elif direction == 'right':
-        new_cur = cur - w+1
-    elif direction == 'up' and cur > w:
-        new_cur = cur - (w+1)
+        col = (col + 1) % image.w
     elif direction == 'up':
-        new_cur = (h-1)*(w+1) + cur
-    elif direction == 'down' and row < h - 1:
-        new_cur = cur + w+1
+        row = (row - 1) % image.h
     elif direction == 'down':
-        new_cur = cur % (w+1)
-    
-    image = image[:cur] + Canvas.ENUM_COLORS[Canvas.color_from_char(image[cur])] + image[cur+1:]
-    image = image[:new_cur] + Canvas.ENUM_CURSOR[Canvas.color_from_char(image[new_cur])] + image[new_cur+1:]
-    controller = Canvas.copy_controller(command_response)
-    bot.reply_interaction(command_response['id'], command_response['token'], image, components=controller, edit=True)
+        row = (row + 1) % image.h
+    state.cursor = row * (image.w+1) + col
+    state.shown = True
+
+    image = image.edit([
+        (cur, Canvas.ENUM_COLORS[Canvas.color_from_char(image.cell(cur))]),
+        (state.cursor, Canvas.ENUM_CURSOR[Canvas.color_from_char(image.cell(state.cursor))])
+    ])
+    bot.reply_interaction(command_response['id'], command_response['token'], image.content, components=Canvas.controller(state), edit=True)
     Stats.move += 1
 
 '''
 Callback function where the user selects the drawing color
 '''
 def choose_color(command_response):
-    image = command_response['message']['content']
-    color = command_response['data']['values'][0]
-    controller = Canvas.copy_controller(command_response)
-    controller = Canvas.set_controller_color(controller, color)
+    state = CanvasState.from_interaction(command_response)
+    if not state:
+        return Canvas.expired(command_response)
+    image = Canvas.editor_image(command_response, state)
+    state.color = command_response['data']['values'][0]
 
-    bot.reply_interaction(command_response['id'], command_response['token'], image, components=controller, edit=True)
+    bot.reply_interaction(command_response['id'], command_response['token'], image.content, components=Canvas.controller(state), edit=True)
     Stats.color += 1
 
 '''
 Callback function for setting a pixel to the selected color
 '''
 def draw(command_response):
-    channel_id, message_id = Canvas.unpack_data(command_response)
-    private = channel_id == 'none'
-
-    image_edit = command_response['message']['content']
-    image_public = command_response['message']['content'] if private else Canvas.get_image(channel_id, message_id)
-    controller = Canvas.copy_controller(command_response)
-
-    cur, w, h = Canvas.load_canvas(image_edit)
-    if cur == -1:
-        cur = 0
-
-    fill_color = 'WHITE'
-    for op in command_response['message']['components'][1]['components'][0]['options']:
-        if 'default' in op and op['default']:
-            fill_color = op['value']
-            break
-    
-    image_edit = image_public[:cur] + Canvas.ENUM_CURSOR[fill_color] + image_public[cur+1:]
-    image_public = image_public[:cur] + Canvas.ENUM_COLORS[fill_color] + image_public[cur+1:]
-
-    bot.reply_interaction(command_response['id'], command_response['token'], image_edit, components=controller, edit=True)
-    if not private:
-        imgcache.put((channel_id, message_id), image_public)
-        bot.edit_message(channel_id, message_id, image_public)
+    state = CanvasState.from_interaction(command_response)
+    if not state:
+        return Canvas.expired(command_response)
+    cur = state.cursor
+    delta = [(cur, Canvas.ENUM_COLORS[state.color])]
+
+    if state.private:
+        image_public = RowCanvas.parse(command_response['message']['content']).edit(delta)
+    else:
+        image_public, state.version = Canvas.edit_image(state.channel_id, state.message_id, delta)
+    state.shown = True
+    image_edit = image_public.edit([(cur, Canvas.ENUM_CURSOR[state.color])])
+
+    bot.reply_interaction(command_response['id'], command_response['token'], image_edit.content, components=Canvas.controller(state), edit=True)
+    if not state.private:
+        bot.edit_message(state.channel_id, state.message_id, image_public.content, version=state.version)
     Stats.draw += 1
 
 '''
 Toggles the cursor to make it visible/invisible
 '''
 def toggle_cursor(command_response):
-    image = command_response['message']['content']
-    cur, w, h = Canvas.load_canvas(image)
-    controller = Canvas.copy_controller(command_response)
-    
-    show_c = 0
-    if cur == -1:
-        cur = 0
-        show_c = 1
-    
-    color = Canvas.color_from_char(image[cur])
-    image = image[:cur] + (Canvas.ENUM_CURSOR[color] if show_c else Canvas.ENUM_COLORS[color]) + image[cur+1:]
-    bot.reply_interaction(command_response['id'], command_response['token'], image, components=controller, edit=True)
+    state = CanvasState.from_interaction(command_response)
+    if not state:
+        return Canvas.expired(command_response)
+    image = Canvas.editor_image(command_response, state)
+    state.shown = not state.shown
+
+    color = Canvas.color_from_char(image.cell(state.cursor))
+    image = image.edit([(state.cursor, Canvas.ENUM_CURSOR[color] if state.shown else Canvas.ENUM_COLORS[color])])
+    bot.reply_interaction(command_response['id'], command_response['token'], image.content, components=Canvas.controller(state), edit=True)
     Stats.cur += 1
 
+'''
+Callback function for the command '/export'. Replies with a png image of a public canvas.
+Rendering runs on the bot's thread pool. A canvas that is not cached is fetched after
+deferring the reply, since the fetch may not finish before the interaction's deadline.
+'''
+def export(command_response):
+    options = {op['name']: op['value'] for op in command_response['data']['options']}
+    scale = options.get('scale', 16)
+    interaction_id = command_response['id']
+    token = command_response['token']
+    ref = Canvas.parse_message_link(options['message'], command_response['channel_id'], command_response.get('guild_id'))
+    error = 'That message is not a canvas in this channel that can be exported.'
+    Stats.export += 1
+    if not ref:
+        return bot.reply_interaction(interaction_id, token, error, hidden=True)
+
+    def render(image, version):
+        return get_renderer().export(ref, version, image.content, scale)
+
+    def rendered(png):
+        bot.reply_interaction(interaction_id, token, '', files=[('canvas.png', png, 'image/png')])
+
+    def failed(e):
+        log.info('Could not export canvas {}: {}'.format(ref, e))
+        bot.reply_interaction(interaction_id, token, error, hidden=True)
+
+    image, version = warmer.get(ref)
+    if image:
+        return bot.tpool.apply_async(render, args=[image, version], callback=rendered, error_callback=failed)
+
+    def fetch():
+        try:
+            png = render(*Canvas.fetch_image(*ref))
+        except Exception as e:
+            log.info('Could not export canvas {}: {}'.format(ref, e))
+            return bot.edit_interaction_reply(token, error)
+        bot.edit_interaction_reply(token, '', files=[('canvas.png', png, 'image/png')])
+
+    bot.defer_interaction(interaction_id, token, then=fetch)
+
+'''
+Callback function for the command '/import'. Converts an uploaded image into a canvas.
+The reply is deferred, and once Discord has accepted the deferral the image is downloaded on
+the bot's thread pool and converted in the converter process pool, so the websocket thread is
+never blocked and the result can not arrive before the deferral.
+'''
+def import_image(command_response):
+    options = {op['name']: op['value'] for op in command_response['data']['options']}
+    attachment = command_response['data']['resolved']['attachments'][options['image']]
+    private = options.get('private', False)
+    token = command_response['token']
+    w, h = Canvas.max_size()
+
+    def converted(image):
+        bot.edit_interaction_reply(token, image, components=Canvas.controller(CanvasState()) if private else Canvas.EDIT_COMPONENT)
+
+    def fetched(data):
+        #Imports numpy and PIL on the first import, which must not happen on the websocket thread
+        from render_service.quantize import image_to_canvas
+        get_converter().apply_async(
+            image_to_canvas,
+            args=[data, w, h, [Canvas.ENUM_RGB[c] for c in Canvas.ENUM_COLORS], list(Canvas.ENUM_COLORS.values())],
+            kwds={'dither': options.get('dither', False)},
+            callback=converted,
+            error_callback=failed
+        )
+
+    def failed(e):
+        log.info('Could not import image {}: {}'.format(attachment.get('filename'), e))
+        bot.edit_interaction_reply(token, 'That file could not be converted to a canvas.')
+
+    def fetch():
+        try:
+            data = attachments.fetch(attachment)
+        except Exception as e:
+            return failed(e)
+        fetched(data)
+
+    bot.defer_interaction(command_response['id'], token, hidden=private, then=fetch)
+    Stats.imports += 1
+
 '''
 Callback method for /help. Returns the url for command refrence
 '''
@@ -517,19 +808,88 @@ def help(command_response):
     )
     Stats.help += 1
 
-bot.register_command(canvas_command, canvas, '--reg' in sys.argv)
-bot.register_command(help_command, help, '--reg' in sys.argv)
-bot.register_command({'name': 'edit'}, edit_mode, False)
-bot.register_command({'name': 'up'}, move, False)
-bot.register_command({'name': 'down'}, move, False)
-bot.register_command({'name': 'left'}, move, False)
-bot.register_command({'name': 'right'}, move, False)
-bot.register_command({'name': 'color_select'}, choose_color, False)
-bot.register_command({'name': 'draw'}, draw, False)
-bot.register_command({'name': 'cursor'}, toggle_cursor, False)
-
-exitcode = 0
-while exitcode >= 0:
-    exitcode = bot.start(resume=exitcode)
-    print(exitcode)
-log.info("Bot terminated")
+'''
+Reads the configuration from the environment, sets up the bot and runs it until it is terminated.
+'''
+def main():
+    from logging.handlers import RotatingFileHandler
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    CLIENT_ID = os.getenv("CLIENT_ID")
+    TOKEN = os.getenv("TOKEN")
+    SHARD_ID = os.getenv("SHARD_ID")
+    SHARD_TOTAL = os.getenv("SHARD_TOTAL")
+
+    handle = RotatingFileHandler('pixgs-s%s.log' % SHARD_ID, mode='a', maxBytes=1024*1024*1024, encoding='utf-8')
+    handle.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(lineno)d %(message)s'))
+    handle.setLevel(logging.INFO)
+    log.setLevel(logging.INFO)
+    log.addHandler(handle)
+
+    setup(CLIENT_ID, TOKEN, int(SHARD_ID), int(SHARD_TOTAL))
+    bot.profiler.rate = int(os.getenv("PROFILE_HZ", 100))
+    bot.profile_command = os.getenv("PROFILE_COMMAND", '*')
+    if os.getenv("CAPTURE"):
+        from discord_service.capture import Capture
+        bot.set_capture(Capture(os.getenv("CAPTURE")))
+    #Application commands are global, so only the first shard keeps them in sync with Discord.
+    #This runs alongside the gateway handshake rather than delaying it.
+    if bot.shard[0] == 0:
+        bot.tpool.apply_async(
+            bot.sync_commands,
+            args=[COMMAND_RECORD],
+            kwds={'force': '--reg' in sys.argv},
+            error_callback=lambda e: log.error('Could not sync application commands: {}'.format(e))
+        )
+
+    exitcode = 0
+    while exitcode >= 0:
+        exitcode = bot.start(resume=exitcode)
+        print(exitcode)
+    if converter:
+        converter.close()
+    if bot.capture:
+        bot.capture.close()
+    log.info("Bot terminated")
+
+'''
+Creates the bot and the image cache and registers the commands, without connecting to Discord.
+Also used by replay.py to run the handlers against a local stand-in for Discord.
+'''
+def setup(client_id: str, token: str, shard_id: int, shard_total: int):
+    global bot, imgcache, warmer, attachments
+    bot = Discbot(client_id, token, shard_id, shard_total, log)
+    imgcache = ImgCache(65536)
+    warmer = CacheWarmer(imgcache, bot.get_message, bot.tpool, RowCanvas.parse, 300)
+    bot.on_interaction = Canvas.ingest
+    bot.on_edited = warmer.confirm
+    bot.on_edit_failed = warmer.failed
+    attachments = HttpAttachmentFetcher()
+
+    bot.register_command(canvas_command, canvas, True)
+    bot.register_command(help_command, help, True)
+    bot.register_command(export_command, export, True)
+    bot.register_command(import_command, import_image, True)
+    bot.register_command({'name': 'edit'}, edit_mode, False)
+    bot.register_command({'name': 'up'}, move, False)
+    bot.register_command({'name': 'down'}, move, False)
+    bot.register_command({'name': 'left'}, move, False)
+    bot.register_command({'name': 'right'}, move, False)
+    bot.register_command({'name': 'color_select'}, choose_color, False)
+    bot.register_command({'name': 'draw'}, draw, False)
+    bot.register_command({'name': 'cursor'}, toggle_cursor, False)
+
+    #Limits are (tokens per second, burst)
+    bot.admission.canvas_key = Canvas.canvas_ref
+    bot.admission.limit(['up', 'down', 'left', 'right', 'cursor', 'color_select'], 'user', 4, 8)
+    bot.admission.limit(['draw'], 'user', 3, 6)
+    bot.admission.limit(['draw'], 'canvas', 8, 16)
+    bot.admission.limit(['canvas', 'edit', 'help'], 'user', .5, 4)
+    bot.admission.limit(['export'], 'user', .2, 3)
+    bot.admission.limit(['import'], 'user', 1 / 30, 2)
+    bot.admission.limit(list(bot.command_registry), 'guild', 20, 40)
+    return bot
+
+if __name__ == '__main__':
+    main()
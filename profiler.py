@@ -0,0 +1,89 @@
+from collections import Counter
+import threading
+import cProfile
+import time
+import sys
+import os
+
+'''
+On demand profiling of a running shard.
+Sampling - While enabled, a background thread records the stack of every other thread
+    rate times per second. When disabled the samples are written in collapsed stack format
+    (one 'thread;frame;frame count' line per unique stack) ready for flamegraph tools.
+Capture - Once armed, the next command callback is run under cProfile and its stats are
+    written to a .prof file.
+Files are named with the prefix and the time they were written.
+'''
+class Profiler():
+    def __init__(self, log, prefix: str, rate=100):
+        self.log = log
+        self.prefix = prefix
+        self.rate = rate          #Samples per second
+        self.sampling = None      #Event stopping the running sampling thread, None while stopped
+        self.capture = None       #Name of the command to capture with cProfile, '*' for any command
+
+    '''
+    Starts sampling if it is stopped, otherwise stops sampling and writes the collected stacks.
+    '''
+    def toggle(self):
+        if self.sampling:
+            #Each run has its own event, so a run started right after this one can not revive it
+            self.sampling.set()
+            self.sampling = None
+        elif self.rate <= 0:
+            self.log.warning('Sampling profiler not started, rate must be positive: {}'.format(self.rate))
+        else:
+            self.sampling = threading.Event()
+            threading.Thread(target=self._sample, args=[self.sampling], daemon=True).start()
+
+    '''
+    Runs the next callback for the command name under cProfile. '*' matches any command.
+    '''
+    def arm(self, command='*'):
+        self.log.info('Profiler armed for command: {}'.format(command))
+        self.capture = command
+
+    '''
+    Runs a command callback, profiling it if a capture is armed for the command.
+    '''
+    def call(self, name: str, callback, data):
+        if self.capture is None or (self.capture != '*' and self.capture != name):
+            return callback(data)
+        self.capture = None
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(callback, data)
+        finally:
+            path = '{}-{}-{}.prof'.format(self.prefix, name, time.strftime('%Y%m%d-%H%M%S'))
+            profile.dump_stats(path)
+            self.log.info('Wrote profile of command {} to {}'.format(name, path))
+
+    def _sample(self, stop: threading.Event):
+        me = threading.get_ident()
+        interval = 1 / self.rate
+        stacks = Counter()
+        labels = {} #A map of code objects to their frame label, formatted once per run
+        count = 0
+        self.log.info('Sampling profiler started at {}Hz'.format(self.rate))
+        while not stop.wait(interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            count += 1
+
+        path = '{}-{}.folded'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S'))
+        with open(path, 'w') as f:
+            for stack, n in stacks.items():
+                f.write('{} {}\n'.format(stack, n))
+        self.log.info('Sampling profiler stopped, wrote {} samples to {}'.format(count, path))
@@ -0,0 +1,56 @@
+from abc import ABC, abstractmethod
+import requests
+import os
+
+'''
+Fetches the contents of Discord message attachments. Handlers are given a fetcher instead
+of downloading attachments themselves so that tests can supply files from disk.
+'''
+class AttachmentFetcher(ABC):
+
+    '''Largest attachment in bytes that will be fetched'''
+    MAX_SIZE = 8 * 1024 * 1024
+
+    '''
+    Returns the bytes of an attachment.
+    attachment - A Discord attachment object
+    Raises ValueError if the attachment is too large.
+    '''
+    def fetch(self, attachment: dict):
+        if attachment.get('size', 0) > AttachmentFetcher.MAX_SIZE:
+            raise ValueError('Attachment is too large')
+        return self._read(attachment)
+
+    '''
+    Returns the bytes of an attachment without checking its size.
+    '''
+    @abstractmethod
+    def _read(self, attachment: dict):
+        pass
+
+'''
+Downloads attachments from the Discord cdn. The cdn needs no authorization, so downloads use
+a session of their own rather than one holding the bot token and connections to the api.
+'''
+class HttpAttachmentFetcher(AttachmentFetcher):
+    def __init__(self, timeout=5):
+        self.session = requests.Session()
+        self.timeout = timeout
+
+    def _read(self, attachment: dict):
+        res = self.session.get(attachment['url'], timeout=self.timeout)
+        res.raise_for_status()
+        if len(res.content) > AttachmentFetcher.MAX_SIZE:
+            raise ValueError('Attachment is too large')
+        return res.content
+
+'''
+Reads attachments from a local directory by their filename.
+'''
+class LocalAttachmentFetcher(AttachmentFetcher):
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _read(self, attachment: dict):
+        with open(os.path.join(self.directory, os.path.basename(attachment['filename'])), 'rb') as f:
+            return f.read()
@@ -0,0 +1,100 @@
+from cache_service.image_cache import ImgCache
+import numpy as np
+import struct
+import zlib
+
+'''
+Renders canvases to PNG images. A canvas string is decoded into an array of palette
+indices, scaled up with numpy broadcasting and written as an indexed color PNG using
+only zlib and struct. Encoded images are cached by (channel id, message id, version),
+so exporting a canvas that has not changed since the last export costs a dict lookup.
+'''
+class PngRenderer():
+
+    PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    NEWLINE = ord('\n')
+
+    '''
+    palette - A list of (chars, rgb) tuples. chars is a tuple of every character that
+              draws the color (pixel and cursor), rgb is the (r, g, b) color to render.
+    cache_size - The number of canvas versions to keep encoded images for.
+    '''
+    def __init__(self, palette: list, cache_size: int):
+        codes = []
+        index = []
+        for i, (chars, rgb) in enumerate(palette):
+            for c in chars:
+                codes.append(ord(c))
+                index.append(i)
+        order = np.argsort(codes)
+        self.codes = np.array(codes, dtype=np.uint32)[order]
+        self.index = np.array(index, dtype=np.uint8)[order]
+        self.plte = bytes(channel for chars, rgb in palette for channel in rgb)
+        self.cache = ImgCache(cache_size)
+
+    '''
+    Returns the png bytes for a canvas, encoding it only if this version of the canvas
+    has not been exported at this scale before.
+    key - The (channel id, message id) of the canvas.
+    version - The version of the canvas as given by the image cache, 0 if the canvas is not
+              cached, in which case the image is encoded without being kept.
+    '''
+    def export(self, key: tuple, version: int, content: str, scale: int):
+        if not version:
+            return self.encode(self.rasterize(self.decode(content), scale))
+        cache_key = key + (version,)
+        images = self.cache.get(cache_key)
+        if images is None:
+            images = {}
+            self.cache.put(cache_key, images)
+        if scale not in images:
+            images[scale] = self.encode(self.rasterize(self.decode(content), scale))
+        return images[scale]
+
+    '''
+    Decodes a canvas string into a h x w array of palette indices.
+    Raises ValueError if the content is not a rectangular canvas of known colors.
+    '''
+    def decode(self, content: str):
+        content = content.partition('\0')[0].strip('\n') + '\n'
+        cells = np.frombuffer(content.encode('utf-32-le'), dtype='<u4')
+        w = int(np.argmax(cells == PngRenderer.NEWLINE))
+        if w == 0 or cells.size % (w + 1):
+            raise ValueError('Canvas is not rectangular')
+        grid = cells.reshape(-1, w + 1)
+        if np.any(grid[:, w] != PngRenderer.NEWLINE):
+            raise ValueError('Canvas is not rectangular')
+
+        grid = grid[:, :w]
+        pos = np.minimum(np.searchsorted(self.codes, grid), self.codes.size - 1)
+        if np.any(self.codes[pos] != grid):
+            raise ValueError('Canvas contains unknown colors')
+        return self.index[pos]
+
+    '''
+    Scales an array of palette indices by an integer factor, each cell becoming a
+    scale x scale block of pixels.
+    '''
+    def rasterize(self, indices, scale: int):
+        h, w = indices.shape
+        blocks = np.broadcast_to(indices[:, None, :, None], (h, scale, w, scale))
+        return blocks.reshape(h * scale, w * scale)
+
+    '''
+    Encodes an array of palette indices as an 8 bit indexed color PNG.
+    '''
+    def encode(self, pixels):
+        h, w = pixels.shape
+        #Each scanline is prefixed with filter type 0 (None)
+        scanlines = np.zeros((h, w + 1), dtype=np.uint8)
+        scanlines[:, 1:] = pixels
+        return b''.join([
+            PngRenderer.PNG_SIGNATURE,
+            PngRenderer._chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 3, 0, 0, 0)),
+            PngRenderer._chunk(b'PLTE', self.plte),
+            PngRenderer._chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)),
+            PngRenderer._chunk(b'IEND', b'')
+        ])
+
+    def _chunk(tag: bytes, data: bytes):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
@@ -0,0 +1,95 @@
+from PIL import Image
+import numpy as np
+import io
+
+'''
+Converts uploaded images into canvas strings. The image is downscaled by averaging
+each block of source pixels that maps onto a canvas cell, and every cell is mapped to
+the nearest palette color, optionally with ordered dithering.
+These functions are run in worker processes and must only take picklable arguments.
+'''
+
+'''4x4 Bayer matrix, normalized to thresholds in [-0.5, 0.5)'''
+BAYER_4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]
+], dtype=np.float32) + 0.5) / 16 - 0.5
+
+'''How far, in rgb units, dithering may push a pixel towards a neighbouring color'''
+DITHER_SPREAD = 96
+
+'''Largest image in pixels that will be decoded. A small compressed file can expand to
+gigabytes when decoded, so larger images are rejected before any pixel data is read.'''
+MAX_PIXELS = 25_000_000
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+'''Images are shrunk to about this many source pixels per canvas cell before being averaged'''
+OVERSAMPLE = 8
+
+'''Modes Image.reduce can shrink without converting the image first'''
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK', 'PA')
+
+'''
+Converts encoded image bytes into a canvas string of at most max_w x max_h cells.
+palette - A list of (r, g, b) tuples
+chars - A list of characters, chars[i] is used to draw palette[i]
+dither - If true ordered dithering is applied before quantizing
+'''
+def image_to_canvas(data: bytes, max_w: int, max_h: int, palette: list, chars: list, dither=False):
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > MAX_PIXELS:
+        raise ValueError('Image is too large')
+    #Lets the jpeg decoder skip detail we are about to average away
+    image.draft('RGB', (max_w * OVERSAMPLE, max_h * OVERSAMPLE))
+    image = shrink(image, max_w * OVERSAMPLE, max_h * OVERSAMPLE)
+    pixels = flatten_alpha(np.asarray(image.convert('RGBA')))
+
+    h, w = pixels.shape[:2]
+    scale = min(max_w / w, max_h / h, 1)
+    cells = downscale(pixels, max(1, round(w * scale)), max(1, round(h * scale)))
+    indices = quantize(cells, np.array(palette, dtype=np.float32), dither)
+    rows = np.array(chars)[indices]
+    return ''.join(''.join(row) + '\n' for row in rows)
+
+'''
+Shrinks an image by the largest integer factor that keeps it at least w x h, averaging each
+block of pixels, so the float arrays built from it stay small however large the upload was.
+'''
+def shrink(image, w: int, h: int):
+    factor = min(image.width // w, image.height // h)
+    if factor < 2:
+        return image
+    if image.mode not in REDUCIBLE_MODES:
+        image = image.convert('RGBA')
+    return image.reduce(factor)
+
+'''
+Composites an h x w x 4 rgba array over a white background, returning an h x w x 3 array.
+'''
+def flatten_alpha(rgba):
+    alpha = rgba[:, :, 3:].astype(np.float32) / 255
+    return rgba[:, :, :3] * alpha + 255 * (1 - alpha)
+
+'''
+Downscales an h x w x 3 array to th x tw x 3 by averaging the source pixels covered by each cell.
+'''
+def downscale(pixels, tw: int, th: int):
+    h, w = pixels.shape[:2]
+    rows = np.arange(th) * h // th
+    cols = np.arange(tw) * w // tw
+    sums = np.add.reduceat(np.add.reduceat(pixels, rows, axis=0), cols, axis=1)
+    counts = np.diff(np.append(rows, h))[:, None] * np.diff(np.append(cols, w))[None, :]
+    return sums / counts[:, :, None]
+
+'''
+Maps every pixel of an h x w x 3 array to the index of the nearest palette color.
+'''
+def quantize(pixels, palette, dither=False):
+    if dither:
+        h, w = pixels.shape[:2]
+        threshold = np.tile(BAYER_4, (h // 4 + 1, w // 4 + 1))[:h, :w]
+        pixels = pixels + threshold[:, :, None] * DITHER_SPREAD
+    distance = ((pixels[:, :, None, :] - palette[None, None, :, :]) ** 2).sum(axis=3)
+    return distance.argmin(axis=2)
@@ -0,0 +1,62 @@
+import sys
+
+'''
+An immutable canvas stored as a tuple of rendered rows, each row ending in a line break.
+Editing a canvas returns a new canvas that re-renders only the rows containing a changed
+pixel and shares every other row with the original. Rows are interned, so identical rows,
+such as the rows of blank canvases, are a single string shared by every canvas using them.
+Pixels are addressed by their index in the canvas content, row * (w + 1) + column.
+'''
+class RowCanvas():
+    __slots__ = ('rows', 'w', '_content')
+
+    def __init__(self, rows: tuple, w: int):
+        self.rows = rows
+        self.w = w
+        self._content = None
+
+    '''
+    Creates a w x h canvas filled with a single character.
+    '''
+    def blank(w: int, h: int, char: str):
+        return RowCanvas((sys.intern(char * w + '\n'),) * h, w)
+
+    '''
+    Splits canvas content into rows. Content after a null character is ignored.
+    '''
+    def parse(content: str):
+        rows = content.partition('\0')[0].strip('\n').split('\n')
+        return RowCanvas(tuple(sys.intern(row + '\n') for row in rows), len(rows[0]))
+
+    @property
+    def h(self):
+        return len(self.rows)
+
+    '''
+    The canvas as message content, joined once and then reused.
+    '''
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = ''.join(self.rows)
+        return self._content
+
+    '''
+    Returns the character at a pixel index.
+    '''
+    def cell(self, index: int):
+        row, col = divmod(index, self.w + 1)
+        return self.rows[row][col]
+
+    '''
+    Returns a copy of the canvas with a list of (index, character) changes applied in order.
+    '''
+    def edit(self, delta: list):
+        dirty = {}
+        for index, char in delta:
+            row, col = divmod(index, self.w + 1)
+            dirty.setdefault(row, list(self.rows[row]))[col] = char
+        rows = list(self.rows)
+        for row, chars in dirty.items():
+            rows[row] = sys.intern(''.join(chars))
+        return RowCanvas(tuple(rows), self.w)
@@ -0,0 +1,191 @@
+from discord_service.capture import Capture
+from discord_service.discbot import Discbot
+from render_service.attachments import LocalAttachmentFetcher
+from collections import Counter
+from datetime import datetime, timezone
+import threading
+import argparse
+import requests
+import logging
+import pixgs
+import json
+import time
+import os
+import re
+
+'''
+Replays a capture recorded with the CAPTURE environment variable through the handlers in
+pixgs.py, with a local stand-in answering the requests that would be sent to Discord.
+Reports throughput, the latency from each interaction being recieved to its reply being sent,
+and wether the requests sent match the ones recorded. Replaying faster than recorded can
+legitimately differ, since edits of a message superseded before being sent are dropped.
+
+usage: python replay.py capture.gz [--speed 1] [--no-limits] [--attachments DIR]
+'''
+
+'''
+A stand-in for Transport that answers requests locally and records them.
+Messages are served from the responses recorded in the capture, and updated by edits.
+'''
+class LocalDiscord():
+
+    MESSAGE_URL = re.compile(r'/channels/(\d+)/messages/(\d+)$')
+
+    def __init__(self, recorded: list):
+        self.calls = []       #List of (time, method, url, body) in the order requests were sent
+        self.messages = {}    #A map of message urls to message objects
+        self.lock = threading.Lock()
+        self.interactions = self.channels = None
+        for out in recorded:
+            if out['m'] == 'get' and 'r' in out and LocalDiscord.MESSAGE_URL.search(out['u']):
+                self.messages.setdefault(out['u'], out['r'])
+
+    def request(self, method: str, url: str, interaction_id=None, **kwds):
+        url = Capture.redact_url(url)
+        with self.lock:
+            self.calls.append((time.perf_counter(), method, url, Capture.body(kwds)))
+            if not LocalDiscord.MESSAGE_URL.search(url):
+                return LocalDiscord._response(200, {})
+            elif method == 'get':
+                message = self.messages.get(url)
+                return LocalDiscord._response(200, message) if message else LocalDiscord._response(404, {})
+            else:
+                channel_id, message_id = LocalDiscord.MESSAGE_URL.search(url).groups()
+                message = self.messages.setdefault(url, {'id': message_id, 'channel_id': channel_id, 'timestamp': LocalDiscord._now()})
+                message.update(kwds.get('json') or {})
+                message['edited_timestamp'] = LocalDiscord._now()
+                return LocalDiscord._response(200, message)
+
+    def prewarm(self, force=False):
+        pass
+
+    def _now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def _response(status: int, body):
+        res = requests.Response()
+        res.status_code = status
+        res._content = json.dumps(body).encode()
+        res.encoding = 'utf-8'
+        return res
+
+'''
+Waits until a thread or process pool has no tasks left.
+'''
+def drain(pool, timeout=30):
+    end = time.perf_counter() + timeout
+    while pool._cache and time.perf_counter() < end:
+        time.sleep(.01)
+
+def percentile(values: list, q: float):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+'''
+Returns a hashable description of a request for comparing recorded and replayed traffic.
+'''
+def signature(method: str, url: str, body):
+    return json.dumps([method, url, normalize(body)], sort_keys=True, ensure_ascii=False)
+
+'''
+Returns a copy of a request body with the canvas version in editor state tokens set to 0.
+Versions are drawn from a process wide counter, so they differ between the recorded bot
+and the replay even when the requests are otherwise the same.
+'''
+def normalize(body):
+    if isinstance(body, list):
+        return [normalize(value) for value in body]
+    if not isinstance(body, dict):
+        return body
+    body = {key: normalize(value) for key, value in body.items()}
+    if isinstance(body.get('custom_id'), str):
+        name, sep, token = body['custom_id'].partition(':')
+        state = pixgs.CanvasState.unpack(token) if sep else None
+        if state:
+            state.version = 0
+            body['custom_id'] = name + ':' + state.pack()
+    return body
+
+def replay(path: str, speed: float, limits: bool, attachments: str):
+    records = list(Capture.read(path))
+    frames = [r for r in records if 'in' in r and r['in']['op'] == Discbot.OP_DISPATCH]
+    recorded = [r['out'] for r in records if 'out' in r]
+    if not frames:
+        print('No gateway dispatches in {}'.format(path))
+        return
+
+    app_id = '0'
+    for frame in frames:
+        if frame['in']['t'] == Discbot.TYPE_READY:
+            app_id = frame['in']['d'].get('application', {}).get('id', app_id)
+
+    pixgs.log.setLevel(logging.ERROR)
+    bot = pixgs.setup(app_id, Capture.REDACTED, 0, 1)
+    local = LocalDiscord(recorded)
+    bot.transport = local
+    pixgs.attachments = LocalAttachmentFetcher(attachments)
+    if not limits:
+        bot.admission.limits = {}
+
+    received = {} #A map of interaction ids to the time they were fed to the bot
+    errors = 0
+    start = time.perf_counter()
+    for frame in frames:
+        if speed:
+            delay = start + (frame['t'] - frames[0]['t']) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if frame['in']['t'] == Discbot.TYPE_INTERACTION:
+            received[frame['in']['d']['id']] = time.perf_counter()
+        try:
+            bot._on_msg(None, json.dumps(frame['in']))
+        except Exception as e:
+            errors += 1
+            print('Frame {} raised: {!r}'.format(frame['in']['s'], e))
+    drain(bot.tpool)
+    if pixgs.converter:
+        drain(pixgs.converter)
+        drain(bot.tpool)
+    elapsed = time.perf_counter() - start
+
+    replied = {}
+    for t, method, url, body in local.calls:
+        match = re.search(r'/interactions/(\d+)/', url)
+        if match and match.group(1) in received and match.group(1) not in replied:
+            replied[match.group(1)] = (t - received[match.group(1)]) * 1000
+    latency = sorted(replied.values())
+
+    expected = Counter(signature(out['m'], out['u'], out['b']) for out in recorded if out['m'] != 'get')
+    actual = Counter(signature(method, url, body) for t, method, url, body in local.calls if method != 'get')
+    missing = expected - actual
+    extra = actual - expected
+
+    print('Replayed {} dispatches ({} interactions) in {:.3f}s, {} raised'.format(len(frames), len(received), elapsed, errors))
+    print('Throughput: {:.1f} interactions/s'.format(len(received) / elapsed if elapsed else 0))
+    print('Reply latency ms: p50 {:.2f} p90 {:.2f} p99 {:.2f} max {:.2f} ({} replied)'.format(
+        percentile(latency, .5), percentile(latency, .9), percentile(latency, .99),
+        latency[-1] if latency else 0, len(latency)
+    ))
+    print('Message fetches: recorded {} replayed {}'.format(
+        sum(1 for out in recorded if out['m'] == 'get'),
+        sum(1 for call in local.calls if call[1] == 'get')
+    ))
+    print('Requests: recorded {} replayed {} matched {} missing {} extra {}'.format(
+        sum(expected.values()), sum(actual.values()), sum((expected & actual).values()),
+        sum(missing.values()), sum(extra.values())
+    ))
+    for request in list(missing)[:5]:
+        print('  missing: {}'.format(request[:200]))
+    for request in list(extra)[:5]:
+        print('  extra: {}'.format(request[:200]))
+    bot.tpool.close()
+    if pixgs.converter:
+        pixgs.converter.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured gateway traffic through the pixgs handlers.')
+    parser.add_argument('capture', help='A capture file written by setting CAPTURE')
+    parser.add_argument('--speed', type=float, default=0, help='Multiple of the recorded speed to replay at, 0 for as fast as possible (default: 0)')
+    parser.add_argument('--no-limits', action='store_true', help='Disable admission control, which depends on timing')
+    parser.add_argument('--attachments', help='Directory to read uploaded images from (default: the directory of the capture)')
+    args = parser.parse_args()
+    replay(args.capture, args.speed, not args.no_limits, args.attachments or os.path.dirname(os.path.abspath(args.capture)))
@@ -11,20 +11,29 @@ class Stats:
     draw = 0
     help = 0
     cur = 0
+    export = 0
+    imports = 0
+    resumes = 0
+    resume_ms = 0
+    replayed = 0
+    duplicates = 0
+    throttled = {'user': 0, 'guild': 0, 'canvas': 0}
     last_day = 0
 
     def out(log):
         t = datetime.now()
         if t.hour == 0 and t.day != Stats.last_day:
             Stats.last_day = t.day
-            log.info('Daily requests: canvases {} edits {} moves {} colors {} draws {} helps {} cursor_tog {}'.format(
+            log.info('Daily requests: canvases {} edits {} moves {} colors {} draws {} helps {} cursor_tog {} exports {} imports {}'.format(
                 Stats.canvases,
                 Stats.edit,
                 Stats.move,
                 Stats.color,
                 Stats.draw,
                 Stats.help,
-                Stats.cur
+                Stats.cur,
+                Stats.export,
+                Stats.imports
             ))
             Stats.canvases = 0
             Stats.edit = 0
@@ -33,6 +42,24 @@ class Stats:
             Stats.draw = 0
             Stats.help = 0
             Stats.cur = 0
+            Stats.export = 0
+            Stats.imports = 0
+            log.info('Daily gateway resumes: resumes {} avg_resume_ms {:.0f} replayed {} duplicates_dropped {}'.format(
+                Stats.resumes,
+                Stats.resume_ms / Stats.resumes if Stats.resumes else 0,
+                Stats.replayed,
+                Stats.duplicates
+            ))
+            Stats.resumes = 0
+            Stats.resume_ms = 0
+            Stats.replayed = 0
+            Stats.duplicates = 0
+            log.info('Daily throttled interactions: user {} guild {} canvas {}'.format(
+                Stats.throttled['user'],
+                Stats.throttled['guild'],
+                Stats.throttled['canvas']
+            ))
+            Stats.throttled = {'user': 0, 'guild': 0, 'canvas': 0}
 
 
 